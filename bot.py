@@ -1,8 +1,11 @@
+import asyncio
 import logging
 from functools import wraps
+
+import orjson
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from sqlalchemy.orm import Session
-from contextlib import contextmanager
+from telegram.error import TelegramError
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -12,25 +15,139 @@ from telegram.ext import (
     ContextTypes,
 )
 
-from database import init_db, DatabaseManager, get_db
-from config import BOT_TOKEN, WEBHOOK_URL, PORT
+from database import init_db, close_db, DatabaseManager, get_db, get_ro_db, get_session
+from config import (
+    BOT_TOKEN,
+    WEBHOOK_URL,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    PORT,
+    POLL_TIMEOUT,
+    POLL_INTERVAL,
+    CREATE_TABLES,
+    CONCURRENT_UPDATES,
+    LOG_FORMAT,
+    LOG_LEVEL,
+)
 
 # -------------------- Logging --------------------
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO
-)
+# Configured here only; other modules just call logging.getLogger(__name__)
+logging.basicConfig(format=LOG_FORMAT, level=LOG_LEVEL)
 logger = logging.getLogger(__name__)
 
-# -------------------- Initialize DB --------------------
-init_db()
+# Only the update kinds the handlers below consume
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+# -------------------- HTTP Client --------------------
+class OrjsonRequest(HTTPXRequest):
+    """HTTPXRequest that parses Telegram's JSON responses with orjson."""
+
+    @staticmethod
+    def parse_json_payload(payload: bytes) -> dict:
+        try:
+            return orjson.loads(payload)
+        except orjson.JSONDecodeError as exc:
+            logger.error("Can not load invalid JSON data: %r", payload)
+            raise TelegramError("Invalid server response") from exc
+
+# -------------------- Static Replies --------------------
+# Built once at import instead of on every handler call
+START_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📊 My Stats", callback_data='stats')],
+    [InlineKeyboardButton("💬 Recent Messages", callback_data='messages')],
+    [InlineKeyboardButton("❓ Help", callback_data='help')]
+])
+
+START_TEXT = (
+    "👋 Hello %s!\n\n"
+    "Welcome to the SQL-based Telegram Bot!\n"
+    "I'm logging all your messages to the database.\n\n"
+    "Use the buttons below to explore features:"
+)
+
+HELP_TEXT = (
+    "*Available Commands:*\n"
+    "/start - Start the bot\n"
+    "/help - Show this help message\n"
+    "/stats - Show your statistics\n"
+    "/messages - Show your recent messages\n\n"
+    "*Features:*\n"
+    "✅ Stores all messages in SQL database\n"
+    "✅ Tracks user activity\n"
+    "✅ Provides usage statistics\n"
+    "✅ Shows message history"
+)
+
+SAVED_TEXT = (
+    "✅ Message saved!\n\n"
+    "💡 Send /stats to see your statistics\n"
+    "💡 Send /messages to see your recent messages"
+)
+
+GREETINGS = frozenset({'hello', 'hi', 'hey'})
+
+PREVIEW_LENGTH = 50
+
+def preview(text):
+    """Shorten a stored message to PREVIEW_LENGTH characters for listings."""
+    if text and len(text) > PREVIEW_LENGTH:
+        return text[:PREVIEW_LENGTH] + "..."
+    return text or ""
+
+# -------------------- Message Batching --------------------
+FLUSH_BATCH_SIZE = 200   # Max rows per executemany batch
+FLUSH_INTERVAL = 0.5     # Max seconds a message waits in the queue
+
+message_queue: asyncio.Queue = asyncio.Queue(maxsize=10000)
+
+async def write_messages(rows):
+    """Insert a batch of queued messages, logging (not raising) on failure."""
+    try:
+        async with get_session() as session:
+            await DatabaseManager(session).save_messages(rows)
+    except Exception:
+        logger.exception("Failed to save %d queued messages", len(rows))
+
+async def flush_messages():
+    """Drain the message queue every FLUSH_BATCH_SIZE rows or FLUSH_INTERVAL seconds.
+
+    Exits after writing the final batch once a None sentinel is dequeued.
+    """
+    loop = asyncio.get_running_loop()
+    running = True
+    while running:
+        rows = []
+        row = await message_queue.get()
+        deadline = loop.time() + FLUSH_INTERVAL
+        while row is not None:
+            rows.append(row)
+            timeout = deadline - loop.time()
+            if len(rows) >= FLUSH_BATCH_SIZE or timeout <= 0:
+                break
+            try:
+                row = await asyncio.wait_for(message_queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+        else:
+            running = False  # Sentinel reached
+        if rows:
+            await write_messages(rows)
 
 # -------------------- DB Decorator --------------------
 def with_db(func):
     """Decorator to provide DB session to handlers via context.db"""
     @wraps(func)
     async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
-        with get_db() as session:
+        async with get_db() as session:
+            context.db = DatabaseManager(session)
+            return await func(update, context, *args, **kwargs)
+    return wrapper
+
+def with_ro_db(func):
+    """Like with_db, but the session is read-only (for handlers that only query)"""
+    @wraps(func)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
+        async with get_ro_db() as session:
             context.db = DatabaseManager(session)
             return await func(update, context, *args, **kwargs)
     return wrapper
@@ -40,47 +157,25 @@ def with_db(func):
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send welcome message and store user."""
     user = update.effective_user
-    context.db.get_or_create_user(user)
-
-    keyboard = [
-        [InlineKeyboardButton("📊 My Stats", callback_data='stats')],
-        [InlineKeyboardButton("💬 Recent Messages", callback_data='messages')],
-        [InlineKeyboardButton("❓ Help", callback_data='help')]
-    ]
+    async with context.db.session.begin():
+        await context.db.upsert_user(user)
 
     await update.message.reply_html(
-        f"👋 Hello {user.mention_html()}!\n\n"
-        "Welcome to the SQL-based Telegram Bot!\n"
-        "I'm logging all your messages to the database.\n\n"
-        "Use the buttons below to explore features:",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        START_TEXT % user.mention_html(),
+        reply_markup=START_KEYBOARD
     )
 
-@with_db
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(
-        "*Available Commands:*\n"
-        "/start - Start the bot\n"
-        "/help - Show this help message\n"
-        "/stats - Show your statistics\n"
-        "/messages - Show your recent messages\n\n"
-        "*Features:*\n"
-        "✅ Stores all messages in SQL database\n"
-        "✅ Tracks user activity\n"
-        "✅ Provides usage statistics\n"
-        "✅ Shows message history",
-        parse_mode='Markdown'
-    )
+async def _help_impl(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.effective_message.reply_text(HELP_TEXT, parse_mode='Markdown')
 
-@with_db
-async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Show user statistics."""
+async def _stats_impl(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show user statistics using the session already on context.db."""
     user_id = update.effective_user.id
-    stats = context.db.get_user_stats(user_id)
+    stats = await context.db.get_user_stats(user_id)
 
     if stats:
         user = stats['user']
-        await update.message.reply_text(
+        await update.effective_message.reply_text(
             f"*Your Statistics:* 📊\n\n"
             f"👤 User ID: `{user.telegram_id}`\n"
             f"📝 Username: @{user.username or 'N/A'}\n"
@@ -90,24 +185,44 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode='Markdown'
         )
     else:
-        await update.message.reply_text("No statistics found. Send a message first!")
+        await update.effective_message.reply_text("No statistics found. Send a message first!")
 
-@with_db
-async def messages_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Show recent messages."""
+async def _messages_impl(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show recent messages using the session already on context.db."""
     user_id = update.effective_user.id
-    messages = context.db.get_user_messages(user_id, limit=5)
+    messages = await context.db.get_user_messages(user_id, limit=5)
 
     if messages:
-        text = "*Your Recent Messages:*\n\n"
-        for msg in reversed(messages):
-            time = msg.created_at.strftime("%H:%M:%S")
-            preview = msg.text[:50] + "..." if len(msg.text) > 50 else msg.text
-            text += f"🕐 {time} - {preview}\n"
+        parts = ["*Your Recent Messages:*\n\n"]
+        parts.extend(
+            f"🕐 {msg.created_at:%H:%M:%S} - {preview(msg.text)}\n"
+            for msg in reversed(messages)
+        )
+        text = "".join(parts)
     else:
         text = "No messages found. Start chatting!"
 
-    await update.message.reply_text(text, parse_mode='Markdown')
+    await update.effective_message.reply_text(text, parse_mode='Markdown')
+
+# Callback data -> handler body; reuses button_callback's session
+CALLBACK_ROUTES = {
+    'stats': _stats_impl,
+    'messages': _messages_impl,
+    'help': _help_impl,
+}
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await _help_impl(update, context)
+
+@with_ro_db
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show user statistics."""
+    await _stats_impl(update, context)
+
+@with_ro_db
+async def messages_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show recent messages."""
+    await _messages_impl(update, context)
 
 @with_db
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -116,41 +231,51 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message = update.effective_message
     text = message.text.strip().lower()
 
-    # Save to DB
-    db_user = context.db.get_or_create_user(user)
-    context.db.save_message(
-        user_id=db_user.id,
-        message_id=message.message_id,
-        text=message.text,
-        chat_id=message.chat_id
-    )
+    # Save to DB: upsert user now, queue the message for the batch flusher
+    async with context.db.session.begin():
+        user_id = await context.db.upsert_user(user)
+    await message_queue.put({
+        'user_id': user_id,
+        'message_id': message.message_id,
+        'text': message.text,
+        'chat_id': message.chat_id
+    })
 
     # Simple responses
-    if text in ['hello', 'hi', 'hey']:
+    if text in GREETINGS:
         await message.reply_text(f"👋 Hello {user.first_name or 'there'}! Your message is saved. 📊")
     else:
-        await message.reply_text(
-            "✅ Message saved!\n\n"
-            "💡 Send /stats to see your statistics\n"
-            "💡 Send /messages to see your recent messages"
-        )
+        await message.reply_text(SAVED_TEXT)
 
-@with_db
+@with_ro_db
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle button callbacks."""
     query = update.callback_query
     await query.answer()
 
     # Route based on callback data
-    if query.data == 'stats':
-        await stats_command(update, context)
-    elif query.data == 'messages':
-        await messages_command(update, context)
-    elif query.data == 'help':
-        await help_command(update, context)
+    handler = CALLBACK_ROUTES.get(query.data)
+    if handler:
+        await handler(update, context)
+
+async def post_init(application: Application):
+    """Create tables (if enabled) and start the message flusher inside the bot's event loop."""
+    if CREATE_TABLES:
+        await init_db()
+    application.bot_data['flusher'] = asyncio.create_task(flush_messages())
+
+async def post_shutdown(application: Application):
+    """Stop the flusher after it has written out everything still queued, then close the pool."""
+    flusher = application.bot_data.pop('flusher', None)
+    if flusher:
+        await message_queue.put(None)
+        await flusher
+    await close_db()
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.error(f"Update {update} caused error {context.error}")
+    # Log only the update id: formatting the whole Update is costly under error storms
+    update_id = update.update_id if isinstance(update, Update) else None
+    logger.error("Update %s caused error %s", update_id, context.error, exc_info=context.error)
 
 # -------------------- Main --------------------
 def main():
@@ -158,25 +283,46 @@ def main():
         logger.error("BOT_TOKEN not found. Please set it in your .env file.")
         return
 
-    application = Application.builder().token(BOT_TOKEN).build()
+    # HTTP/2 multiplexes all Bot API calls over one TLS connection
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(OrjsonRequest(http_version="2", connection_pool_size=256))
+        .get_updates_request(OrjsonRequest(http_version="2"))
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # Register handlers
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("stats", stats_command))
-    application.add_handler(CommandHandler("messages", messages_command))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    application.add_handler(CallbackQueryHandler(button_callback))
+    # Handlers do DB I/O: block=False keeps the update loop moving while they await
+    application.add_handler(CommandHandler("start", start, block=False))
+    application.add_handler(CommandHandler("help", help_command, block=False))
+    application.add_handler(CommandHandler("stats", stats_command, block=False))
+    application.add_handler(CommandHandler("messages", messages_command, block=False))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message, block=False))
+    application.add_handler(CallbackQueryHandler(button_callback, block=False))
     application.add_error_handler(error_handler)
 
-    # Start bot: Prefer polling for simplicity
+    # Start bot: webhooks are push-based, long polling is the fallback
     if WEBHOOK_URL:
         logger.info("Starting bot in webhook mode...")
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
-        #application.run_webhook(listen="0.0.0.0", port=PORT, webhook_url=WEBHOOK_URL)
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=WEBHOOK_PATH.lstrip("/"),
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=ALLOWED_UPDATES
+        )
     else:
         logger.info("Starting bot in polling mode...")
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        application.run_polling(
+            allowed_updates=ALLOWED_UPDATES,
+            timeout=POLL_TIMEOUT,
+            poll_interval=POLL_INTERVAL
+        )
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
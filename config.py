@@ -1,4 +1,5 @@
 import os
+from dataclasses import dataclass, field
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -15,19 +16,30 @@ PORT = int(os.getenv("PORT", "8080"))
 # Database Configuration
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./telegram_bot.db")
 
+
+@dataclass(slots=True, frozen=True)
+class DbConfig:
+    """Engine settings, read once at import."""
+    url: str
+    pool_size: int = 20
+    max_overflow: int = 30
+    pool_pre_ping: bool = True   # Avoid stale DB connections
+    pool_recycle: int = 1800     # Recycle every 30 min to prevent timeout
+    connect_args: dict = field(default_factory=dict)
+
+
 if DATABASE_URL.startswith("postgresql"):
-    DATABASE_CONFIG = {
-        'url': DATABASE_URL,
-        'pool_size': 20,
-        'max_overflow': 30,
-        'pool_pre_ping': True,
-        'pool_recycle': 3600
-    }
+    DATABASE_CONFIG = DbConfig(url=DATABASE_URL)
 else:
-    DATABASE_CONFIG = {
-        'url': DATABASE_URL,
-        'connect_args': {"check_same_thread": False}  # SQLite fix
-    }
+    DATABASE_CONFIG = DbConfig(
+        url=DATABASE_URL,
+        pool_size=5,
+        max_overflow=10,
+        connect_args={"check_same_thread": False}  # SQLite fix
+    )
+
+# Run create_all on startup; disable once the schema exists (e.g. pre-forked workers)
+CREATE_TABLES = os.getenv("CREATE_TABLES", "True").lower() == "true"
 
 # Bot Metadata
 BOT_NAME = "SQL Telegram Bot"
@@ -35,12 +47,19 @@ BOT_DESCRIPTION = "A feature-rich Telegram bot with SQL database storage"
 BOT_VERSION = "1.0.0"
 
 # Logging
-LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()  # logging only accepts upper-case names
 LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 
 # Webhook Settings
 WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
 WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
 
+# Polling Settings (long polling: Telegram holds getUpdates open up to POLL_TIMEOUT seconds)
+POLL_TIMEOUT = int(os.getenv("POLL_TIMEOUT", "30"))
+POLL_INTERVAL = float(os.getenv("POLL_INTERVAL", "0.0"))
+
+# Maximum number of updates processed at the same time
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "256"))
+
 # Development
 DEBUG = os.getenv("DEBUG", "False").lower() == "true"
\ No newline at end of file
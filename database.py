@@ -1,109 +1,288 @@
+import asyncio
 import logging
 import os
-from datetime import datetime
-from contextlib import contextmanager
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text, Boolean, ForeignKey
-from sqlalchemy.orm import declarative_base, sessionmaker, relationship
-from config import DATABASE_CONFIG
+from collections import Counter
+from contextlib import asynccontextmanager
+from functools import partial
+from cachetools import TTLCache
+from sqlalchemy import inspect, Column, Integer, BigInteger, String, DateTime, Text, Boolean, ForeignKey, Index, event, select, insert, update, bindparam
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import Session, declarative_base, relationship
+from sqlalchemy.sql.expression import FunctionElement
+from config import DATABASE_CONFIG, LOG_FORMAT, LOG_LEVEL
 
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger(__name__)
 
 Base = declarative_base()
 
+# Async drivers for the plain URLs accepted in DATABASE_URL
+ASYNC_DRIVERS = {
+    "postgresql://": "postgresql+asyncpg://",
+    "sqlite://": "sqlite+aiosqlite://",
+}
+
+
+def to_async_url(url):
+    """Rewrite a plain database URL to use its asyncio driver."""
+    for prefix, async_prefix in ASYNC_DRIVERS.items():
+        if url.startswith(prefix):
+            return async_prefix + url[len(prefix):]
+    return url
+
+
 # Database setup
-db_url = DATABASE_CONFIG.get('url', 'sqlite:///telegram_bot.db')
+db_url = make_url(to_async_url(DATABASE_CONFIG.url))
 
-# Optional: Thread-safe for SQLite (ignore for Postgres)
-extra_args = {}
-if db_url.startswith("sqlite"):
-    extra_args["connect_args"] = {"check_same_thread": False}
+# Sizing only applies to queue pools; in-memory SQLite keeps its StaticPool
+pool_args = {}
+if db_url.get_backend_name() != "sqlite" or db_url.database not in (None, "", ":memory:"):
+    pool_args = {
+        'pool_size': DATABASE_CONFIG.pool_size,
+        'max_overflow': DATABASE_CONFIG.max_overflow
+    }
+# aiosqlite defaults to NullPool (a new connection and thread per session);
+# pool file databases so connections and their PRAGMAs are reused
+if db_url.get_backend_name() == "sqlite" and pool_args:
+    pool_args['poolclass'] = AsyncAdaptedQueuePool
 
-engine = create_engine(
+engine = create_async_engine(
     db_url,
-    **extra_args,
-    pool_pre_ping=True,          # Avoid stale DB connections
-    pool_recycle=1800            # Recycle every 30 min to prevent timeout
+    **pool_args,
+    pool_pre_ping=DATABASE_CONFIG.pool_pre_ping,
+    pool_recycle=DATABASE_CONFIG.pool_recycle,
+    connect_args=DATABASE_CONFIG.connect_args
+)
+
+# SQLite tuning: WAL lets readers run alongside the writer and makes commits append-only
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA busy_timeout=5000",
 )
-SessionLocal = sessionmaker(
-    autocommit=False,
+
+if engine.dialect.name == "sqlite":
+    @event.listens_for(engine.sync_engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        """Apply SQLITE_PRAGMAS to every new SQLite connection."""
+        cursor = dbapi_connection.cursor()
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+        cursor.close()
+
+# Dialect-specific INSERT supporting ON CONFLICT ... DO UPDATE
+upsert_insert = pg_insert if engine.dialect.name == "postgresql" else sqlite_insert
+
+SessionLocal = async_sessionmaker(
+    engine,
     autoflush=False,
-    bind=engine,
     expire_on_commit=False)
 
-# Define models
+# In-process caches: telegram_id -> User, users.id -> stats dict
+user_cache = TTLCache(maxsize=10000, ttl=300)
+stats_cache = TTLCache(maxsize=10000, ttl=30)
+# users.id -> number of committed stats invalidations, checked before caching a read
+stats_versions = Counter()
+
+
+def invalidate_stats(user_id):
+    """Drop a user's cached stats and mark any read already in flight as stale."""
+    stats_versions[user_id] += 1
+    stats_cache.pop(user_id, None)
+
+
+def same_profile(user, telegram_user):
+    """Check whether a stored user still matches the incoming Telegram profile."""
+    return (user.username, user.first_name, user.last_name, user.language_code) == (
+        telegram_user.username, telegram_user.first_name,
+        telegram_user.last_name, telegram_user.language_code)
+
+class utcnow(FunctionElement):
+    """Current UTC time, evaluated by the database."""
+    type = DateTime()
+    inherit_cache = True
+
+@compiles(utcnow)
+def compile_utcnow(element, compiler, **kw):
+    return "CURRENT_TIMESTAMP"  # Already UTC on SQLite
+
+@compiles(utcnow, "postgresql")
+def compile_utcnow_postgresql(element, compiler, **kw):
+    # now() follows the session TimeZone; convert so naive columns hold UTC
+    return "TIMEZONE('utc', CURRENT_TIMESTAMP)"
+
+# Define models (relationships are lazy="raise": load them explicitly with selectinload)
 class User(Base):
     __tablename__ = 'users'
     id = Column(Integer, primary_key=True)
-    telegram_id = Column(Integer, unique=True, nullable=False)
+    telegram_id = Column(BigInteger, unique=True, nullable=False, index=True)  # Telegram IDs exceed 2^31
     username = Column(String(50))
     first_name = Column(String(50))
     last_name = Column(String(50))
     language_code = Column(String(10))
     is_active = Column(Boolean, default=True)
-    created_at = Column(DateTime, default=datetime.utcnow)
-    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    message_count = Column(Integer, default=0, nullable=False)  # Kept in step with message inserts
+    # SQL-side UTC timestamps; default= also covers tables created before server_default
+    created_at = Column(DateTime, default=utcnow(), server_default=utcnow())
+    updated_at = Column(DateTime, default=utcnow(), server_default=utcnow(), onupdate=utcnow())
 
-    messages = relationship("Message", back_populates="user", cascade="all, delete-orphan")
-    sessions = relationship("ChatSession", back_populates="user", cascade="all, delete-orphan")
+    # Fetch server-generated timestamps on flush so detached/cached rows stay readable
+    __mapper_args__ = {"eager_defaults": True}
+
+    messages = relationship("Message", back_populates="user", cascade="all, delete-orphan", lazy="raise")
+    sessions = relationship("ChatSession", back_populates="user", cascade="all, delete-orphan", lazy="raise")
 
 class Message(Base):
     __tablename__ = 'messages'
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
-    message_id = Column(Integer)
+    message_id = Column(BigInteger)
     text = Column(Text)
-    chat_id = Column(Integer)
+    chat_id = Column(BigInteger, index=True)  # Negative 64-bit for groups/channels
     message_type = Column(String(20), default='text')
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, default=utcnow(), server_default=utcnow())
+
+    # Serves get_user_messages (ORDER BY created_at DESC, id DESC LIMIT n)
+    __table_args__ = (
+        Index('ix_messages_user_created', user_id, created_at.desc(), id.desc()),
+    )
 
-    user = relationship("User", back_populates="messages")
+    user = relationship("User", back_populates="messages", lazy="raise")
 
 class ChatSession(Base):
     __tablename__ = 'chat_sessions'
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     session_data = Column(Text)
-    created_at = Column(DateTime, default=datetime.utcnow)
-    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    created_at = Column(DateTime, default=utcnow(), server_default=utcnow())
+    updated_at = Column(DateTime, default=utcnow(), server_default=utcnow(), onupdate=utcnow())
 
-    user = relationship("User", back_populates="sessions")
+    __mapper_args__ = {"eager_defaults": True}
 
+    user = relationship("User", back_populates="sessions", lazy="raise")
 
-def init_db():
-    """Initialize the database with all tables"""
-    logging.info("Initializing database...")
-    logging.info(f"DB Path: {os.path.abspath('telegram_bot.db')}")
-    Base.metadata.create_all(bind=engine)
-    logging.info("Database tables created successfully.")
 
-@contextmanager
-def get_db():
-    """Yield a database session for use in context managers."""
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+def add_message_count_column(conn):
+    """Add and backfill users.message_count on databases created before it existed."""
+    columns = {column['name'] for column in inspect(conn).get_columns('users')}
+    if 'message_count' in columns:
+        return
+    logger.info("Adding users.message_count and backfilling it from messages...")
+    conn.exec_driver_sql("ALTER TABLE users ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0")
+    conn.exec_driver_sql(
+        "UPDATE users SET message_count = "
+        "(SELECT count(*) FROM messages WHERE messages.user_id = users.id)"
+    )
 
-@contextmanager
-def get_session():
-    session = SessionLocal()
+def widen_bigint_columns(conn):
+    """ALTER id columns created as INTEGER to BIGINT (PostgreSQL; SQLite integers are 64-bit)."""
+    if conn.dialect.name != "postgresql":
+        return
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        existing = {column['name']: column['type'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if (isinstance(column.type, BigInteger) and column.name in existing
+                    and not isinstance(existing[column.name], BigInteger)):
+                logger.info("Widening %s.%s to BIGINT...", table.name, column.name)
+                conn.exec_driver_sql(
+                    f"ALTER TABLE {table.name} ALTER COLUMN {column.name} TYPE BIGINT"
+                )
+
+def create_missing_indexes(conn):
+    """Create model indexes that create_all skips because their table already exists."""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+_initialized = False
+
+async def init_db():
+    """Initialize the database with all tables (once per process)"""
+    global _initialized
+    if _initialized:
+        return
+    logger.info("Initializing database...")
+    logger.info("DB Path: %s", os.path.abspath('telegram_bot.db'))
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(add_message_count_column)
+        await conn.run_sync(widen_bigint_columns)
+        await conn.run_sync(create_missing_indexes)
+    _initialized = True
+    logger.info("Database tables created successfully.")
+
+async def close_db():
+    """Close pooled connections (and aiosqlite's worker threads) on shutdown"""
+    await engine.dispose()
+
+async def create_schema():
+    """One-shot schema setup for scripts: init_db, then release the pool so the process can exit"""
     try:
-        yield session
-        session.commit()
-    except:
-        session.rollback()
-        raise
+        await init_db()
     finally:
-        session.close()
+        await close_db()
+
+@asynccontextmanager
+async def get_db():
+    """Yield a database session for use in async context managers."""
+    async with SessionLocal() as db:
+        yield db
+
+@asynccontextmanager
+async def get_ro_db():
+    """Yield a session whose transactions are READ ONLY (enforced on PostgreSQL)."""
+    async with SessionLocal(info={'readonly': True}) as db:
+        yield db
+
+@event.listens_for(Session, "after_begin")
+def set_read_only(session, transaction, connection):
+    """Issue SET TRANSACTION READ ONLY for sessions opened by get_ro_db."""
+    if session.info.get('readonly') and connection.dialect.name == "postgresql":
+        connection.exec_driver_sql("SET TRANSACTION READ ONLY")
+
+def after_commit(session, callback):
+    """Run callback once the session's transaction commits; it is dropped on rollback."""
+    session.info.setdefault('after_commit', []).append(callback)
+
+@event.listens_for(Session, "after_commit")
+def run_after_commit(session):
+    for callback in session.info.pop('after_commit', []):
+        callback()
+
+@event.listens_for(Session, "after_rollback")
+def discard_after_commit(session):
+    session.info.pop('after_commit', None)
+
+@asynccontextmanager
+async def get_session():
+    async with SessionLocal() as session:
+        try:
+            yield session
+            await session.commit()
+        except:
+            await session.rollback()
+            raise
 
 # ----------------- Database Manager -----------------
 class DatabaseManager:
     def __init__(self, session):
         self.session = session
 
-    def get_or_create_user(self, telegram_user):
-        user = self.session.query(User).filter_by(telegram_id=telegram_user.id).first()
+    async def get_or_create_user(self, telegram_user):
+        cached = user_cache.get(telegram_user.id)
+        if cached:
+            return cached
+        result = await self.session.execute(
+            select(User).where(User.telegram_id == telegram_user.id)
+        )
+        user = result.scalar_one_or_none()
         if not user:
             user = User(
                 telegram_id=telegram_user.id,
@@ -113,11 +292,45 @@ class DatabaseManager:
                 language_code=telegram_user.language_code
             )
             self.session.add(user)
-            self.session.flush()
-            logging.info(f"Created new user: {telegram_user.username or telegram_user.id}")
+            await self.session.flush()
+            logger.info("Created new user: %s", telegram_user.username or telegram_user.id)
+        # Only cache rows that are known to be committed
+        after_commit(self.session, partial(user_cache.__setitem__, telegram_user.id, user))
         return user
 
-    def save_message(self, user_id, message_id, text, chat_id):
+    async def upsert_user(self, telegram_user):
+        """Insert or refresh a user in one round trip and return its primary key.
+
+        Skipped entirely while the cached row still matches the Telegram profile.
+        """
+        cached = user_cache.get(telegram_user.id)
+        if cached and same_profile(cached, telegram_user):
+            return cached.id
+        stmt = upsert_insert(User).values(
+            telegram_id=telegram_user.id,
+            username=telegram_user.username,
+            first_name=telegram_user.first_name,
+            last_name=telegram_user.last_name,
+            language_code=telegram_user.language_code
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[User.telegram_id],
+            set_={
+                'username': stmt.excluded.username,
+                'first_name': stmt.excluded.first_name,
+                'last_name': stmt.excluded.last_name,
+                'language_code': stmt.excluded.language_code,
+                'updated_at': utcnow()
+            }
+        ).returning(User)
+        result = await self.session.scalars(stmt, execution_options={'populate_existing': True})
+        user = result.one()
+        after_commit(self.session, partial(user_cache.__setitem__, telegram_user.id, user))
+        after_commit(self.session, partial(invalidate_stats, user.id))
+        return user.id
+
+    async def save_message(self, user_id, message_id, text, chat_id):
+        """Add a message to the current transaction; the caller commits."""
         msg = Message(
             user_id=user_id,
             message_id=message_id,
@@ -125,32 +338,67 @@ class DatabaseManager:
             chat_id=chat_id
         )
         self.session.add(msg)
-        self.session.commit()
+        await self.session.flush()
+        await self.session.execute(
+            update(User).where(User.id == user_id).values(message_count=User.message_count + 1)
+        )
+        # Invalidate once committed, so concurrent /stats can't re-cache the old count
+        after_commit(self.session, partial(invalidate_stats, user_id))
 
-    def get_user_messages(self, user_id, limit=5):
-        return self.session.query(Message).filter_by(user_id=user_id)\
-            .order_by(Message.created_at.desc()).limit(limit).all()
+    async def save_messages(self, rows):
+        """Bulk insert a batch of message dicts with one executemany INSERT."""
+        await self.session.execute(insert(Message).execution_options(render_nulls=True), rows)
+        counts = Counter(row['user_id'] for row in rows)
+        users = User.__table__
+        await self.session.execute(
+            update(users).where(users.c.id == bindparam('uid'))
+            .values(message_count=users.c.message_count + bindparam('added')),
+            [{'uid': user_id, 'added': added} for user_id, added in counts.items()]
+        )
+        for user_id in counts:
+            after_commit(self.session, partial(invalidate_stats, user_id))
+
+    async def get_user_messages(self, user_id, limit=5):
+        """Return the latest messages of the user with Telegram id user_id."""
+        result = await self.session.execute(
+            select(Message).join(User, Message.user_id == User.id)
+            .where(User.telegram_id == user_id)
+            .order_by(Message.created_at.desc(), Message.id.desc()).limit(limit)
+        )
+        return result.scalars().all()
 
-    def get_user_stats(self, user_id):
-        user = self.session.query(User).filter_by(telegram_id=user_id).first()
+    async def get_user_stats(self, user_id):
+        """Return stats for a Telegram user id in one query (message_count is denormalized)."""
+        cached = user_cache.get(user_id)
+        if cached and cached.id in stats_cache:
+            return stats_cache[cached.id]
+        version = stats_versions[cached.id] if cached else None
+        user = await self.session.scalar(select(User).where(User.telegram_id == user_id))
         if not user:
             return None
-        message_count = self.session.query(Message).filter_by(user_id=user.id).count()
-        return {
+        stats = {
             "user": user,
-            "message_count": message_count,
+            "message_count": user.message_count,
             "created_at": user.created_at
         }
+        user_cache.setdefault(user.telegram_id, user)
+        # Only cache when no write committed mid-read (needs the id known up front)
+        if version is not None and stats_versions[user.id] == version:
+            stats_cache[user.id] = stats
+        return stats
     @staticmethod
-    def update_user_activity(user_id, is_active=True):
-        with get_session() as session:
-            user = session.query(User).filter_by(id=user_id).first()
+    async def update_user_activity(user_id, is_active=True):
+        async with get_session() as session:
+            result = await session.execute(select(User).where(User.id == user_id))
+            user = result.scalar_one_or_none()
             if user:
                 user.is_active = is_active
-                user.updated_at = datetime.utcnow()
-                logging.info(f"Updated activity for user {user_id}: {is_active}")
-                session.commit()
+                logger.info("Updated activity for user %s: %s", user_id, is_active)
+                await session.commit()
+                user_cache.pop(user.telegram_id, None)
+                invalidate_stats(user.id)
             return user
 
 if __name__ == "__main__":
-    init_db()
\ No newline at end of file
+    logging.basicConfig(format=LOG_FORMAT, level=LOG_LEVEL)
+    asyncio.run(create_schema())
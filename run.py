@@ -10,19 +10,13 @@ from pathlib import Path
 
 from dotenv import load_dotenv
 
-# Configure logging
-logging.basicConfig(
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    level=logging.INFO
-)
-
 # Ensure local modules are importable
 sys.path.insert(0, str(Path(__file__).parent))
 
 # Load environment variables
 load_dotenv()
 
-from bot import main  # Import after sys.path and env setup
+from bot import main  # Import after sys.path and env setup; also configures logging
 
 if __name__ == "__main__":
     bot_token = os.getenv("BOT_TOKEN")
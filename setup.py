@@ -3,6 +3,8 @@
 Setup script for the Telegram bot
 """
 
+import asyncio
+import logging
 import os
 import subprocess
 import sys
@@ -10,9 +12,9 @@ import traceback
 
 
 def check_python_version():
-    """Check if Python 3.7+ is installed"""
-    if sys.version_info < (3, 7):
-        print("❌ Python 3.7 or higher is required")
+    """Check if Python 3.10+ is installed"""
+    if sys.version_info < (3, 10):
+        print("❌ Python 3.10 or higher is required")
         sys.exit(1)
     print(f"✅ Python {sys.version.split()[0]} detected")
 
@@ -54,8 +56,10 @@ def init_database():
             return
 
         print("🗄️  Initializing database...")
-        from database import init_db
-        init_db()
+        from config import LOG_FORMAT, LOG_LEVEL
+        from database import create_schema
+        logging.basicConfig(format=LOG_FORMAT, level=LOG_LEVEL)
+        asyncio.run(create_schema())
         print("✅ Database initialized successfully")
     except Exception:
         print("❌ Failed to initialize database:")